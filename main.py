@@ -14,7 +14,10 @@ import serial
 import time
 import threading
 import sys
+import os
 import select
+import queue
+from dataclasses import dataclass
 
 
 
@@ -34,6 +37,11 @@ COM_TP70 = "COM3"           # change to your TP70 port
 COM_ESP32 = None            # or e.g. "COM5" if using ESP32 relay
 TARGET_AMOUNT = 100         # amount to unlock
 SESSION_TIMEOUT = 60        # seconds
+DEBUG = False               # log every raw ESCROW code
+READ_TIMEOUT = 1.0          # seconds; read blocks until a byte arrives or this expires
+ESCROW_CODE_TIMEOUT = 0.1   # seconds to wait for the bill code after ESCROW
+ESP_BATCH_WINDOW = 0.005    # seconds to gather ESP32 commands into one write
+ESP_BATCH_MAX = 8           # max ESP32 commands per write
 
 BILL_CODES = {0x40: 100, 0x41: 200}  # TP70 bill codes
 
@@ -43,68 +51,203 @@ ESCROW = 0x81
 POWER1 = 0x80
 POWER2 = 0x8F
 
-session = {"amount":0, "last":time.time(), "active":False}
+ACK_BYTE = bytes([ACK])        # prebuilt replies written back to the TP70
+REJECT_BYTE = bytes([REJECT])
+
+@dataclass(slots=True)
+class Session:
+    amount: int = 0
+    last_activity: float = 0.0
+    active: bool = False
+
+    def reset(self):
+        self.amount = 0
+        self.active = False
+        self.last_activity = time.monotonic()
+
+session = Session()
+esp_queue = queue.Queue()  # commands for the ESP32 writer thread; None stops it
 
 def log(msg):
-    print(f"[{time.strftime('%H:%M:%S')}] {msg}")
+    sys.stdout.write(time.strftime('[%H:%M:%S] ') + msg + '\n')
 
 def open_port(port, baud=9600):
     return serial.Serial(port, baudrate=baud, bytesize=8, parity=serial.PARITY_EVEN,
-                         stopbits=1, timeout=0.2)
+                         stopbits=1, timeout=READ_TIMEOUT)
+
+def set_low_latency(port):
+    # USB-serial adapters hold bytes for their latency timer (16 ms on FTDI)
+    # before handing them to the host. pyserial exposes ASYNC_LOW_LATENCY on
+    # Linux only; other platforms raise NotImplementedError (or lack the method)
+    # and drivers without the flag raise ValueError. All keep their default.
+    try:
+        port.set_low_latency_mode(True)
+    except (AttributeError, NotImplementedError, ValueError) as e:
+        log(f"Low-latency mode unavailable: {e}")
+
+def esp_writer(esp):
+    # Runs on its own thread so a slow ESP32 port never stalls the TP70 loop.
+    # Commands queued within ESP_BATCH_WINDOW of each other go out in one write.
+    stop = False
+    while not stop:
+        cmd = esp_queue.get()
+        if cmd is None:
+            return
+        batch = [cmd]
+        deadline = time.monotonic() + ESP_BATCH_WINDOW
+        while len(batch) < ESP_BATCH_MAX:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                cmd = esp_queue.get(timeout=remaining)
+            except queue.Empty:
+                break
+            if cmd is None:
+                stop = True
+                break
+            batch.append(cmd)
+        try:
+            esp.write(b"".join(batch))
+        except serial.SerialException as e:
+            log(f"ESP32 write error: {e}")
 
 def unlock_action(esp):
     log("=== UNLOCK TRIGGERED ===")
     if esp:
-        esp.write(b"UNLOCK\n")
+        esp_queue.put(b"UNLOCK\n")
 
 def lock_action(esp):
     log("=== LOCK TRIGGERED ===")
     if esp:
-        esp.write(b"LOCK\n")
-
-def process_tap(tp, esp):
-    b = tp.read(1)
-    if not b: return
-    c = b[0]
-    if c in (POWER1, POWER2):
-        log("TP70 power-up detected; sending ACK")
-        tp.write(bytes([ACK]))
-    elif c == ESCROW:
-        code = tp.read(1)
-        if not code: return
-        val = BILL_CODES.get(code[0])
-        log(f"ESCROW code 0x{code[0]:02X}, value={val}")
-        if val:
-            tp.write(bytes([ACK]))
-            session["amount"] += val
-            session["last"] = time.time()
-            session["active"] = True
-            log(f"Amount=₱{session['amount']}")
-            if session["amount"] >= TARGET_AMOUNT:
-                unlock_action(esp)
+        esp_queue.put(b"LOCK\n")
+
+def port_fd(port):
+    # The port's file descriptor on POSIX; None on Windows, which has no fd.
+    try:
+        return port.fileno()
+    except (AttributeError, OSError):
+        return None
+
+def read_exactly(port, n, timeout):
+    # Keep reading until n bytes arrive or the deadline passes; may return short.
+    # The wait is bounded here instead of through port.timeout, whose setter
+    # reprograms the UART every time it is assigned.
+    buf = bytearray()
+    deadline = time.monotonic() + timeout
+    fd = port_fd(port)
+    while len(buf) < n:
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            break
+        if fd is not None:
+            ready, _, _ = select.select([fd], [], [], remaining)
+            if ready:
+                try:
+                    buf.extend(os.read(fd, n - len(buf)))
+                except BlockingIOError:
+                    pass
+        elif port.in_waiting:
+            buf.extend(port.read(min(port.in_waiting, n - len(buf))))
         else:
-            tp.write(bytes([REJECT]))
-            log("Rejected unknown bill")
+            time.sleep(0.001)  # about one byte time at 9600 baud
+    return bytes(buf)
+
+def make_reader(port):
+    # On POSIX, select() + os.read() on the raw fd skips pyserial's per-call
+    # overhead; the port is 8E1 with no software flow control, so the kernel
+    # does all the line handling. Windows ports have no fd and use port.read().
+    fd = port_fd(port)
+    if fd is None:
+        return lambda: port.read(max(port.in_waiting, 1))
+
+    def read_chunk():
+        ready, _, _ = select.select([fd], [], [], READ_TIMEOUT)
+        if not ready:
+            return b''
+        try:
+            chunk = os.read(fd, 256)
+        except BlockingIOError:
+            return b''
+        if not chunk:
+            raise serial.SerialException("TP70 port reported data but returned none (disconnected?)")
+        return chunk
+    return read_chunk
+
+def on_power(tp, esp, c):
+    log("TP70 power-up detected; sending ACK")
+    tp.write(ACK_BYTE)
+
+def on_bill(tp, esp, code):
+    val = BILL_CODES[code]
+    if DEBUG:
+        log(f"ESCROW code 0x{code:02X}, value={val}")
+    tp.write(ACK_BYTE)
+    session.amount += val
+    session.last_activity = time.monotonic()
+    session.active = True
+    log(f"Amount=₱{session.amount}")
+    if session.amount >= TARGET_AMOUNT:
+        unlock_action(esp)
+
+def on_unknown_bill(tp, esp, code):
+    if DEBUG:
+        log(f"ESCROW code 0x{code:02X}, value=None")
+    tp.write(REJECT_BYTE)
+    log("Rejected unknown bill")
+
+# TP70 receive states: waiting for a status byte, or for the bill code
+# that follows ESCROW.
+IDLE = 0
+EXPECT_CODE = 1
+
+# (state, byte) -> (next state, action(tp, esp, byte) or None).
+# Pairs not listed leave the state unchanged and are ignored.
+TRANSITIONS = {
+    (IDLE, POWER1): (IDLE, on_power),
+    (IDLE, POWER2): (IDLE, on_power),
+    (IDLE, ESCROW): (EXPECT_CODE, None),
+    **{(EXPECT_CODE, c): (IDLE, on_bill if c in BILL_CODES else on_unknown_bill)
+       for c in range(256)},
+}
+
+def process_tap(tp, esp, read_chunk):
+    # Drain whatever the OS has queued in one read instead of one byte per call.
+    chunk = read_chunk()
+    state = IDLE
+    transition = TRANSITIONS.get
+    while chunk:
+        for c in chunk:
+            state, action = transition((state, c), (state, None))
+            if action:
+                action(tp, esp, c)
+        chunk = b''
+        if state == EXPECT_CODE:
+            # ESCROW was the last byte read; give its bill code a short deadline.
+            chunk = read_exactly(tp, 1, ESCROW_CODE_TIMEOUT)
+            if not chunk:
+                log("ESCROW without bill code; dropped")
+                state = IDLE
 
 def input_listener(tp, esp):
     log("Type 'reset' to restart session.")
-    while True:
-        ready, *_ = select.select([sys.stdin], [], [], 1)
-        if ready:
-            cmd = sys.stdin.readline().strip().lower()
-            if cmd == 'reset':
-                session["amount"] = 0
-                session["active"] = False
-                session["last"] = time.time()
-                log("Session reset by user")
-                lock_action(esp)
+    # Blocks in readline() until a line arrives; returns at EOF.
+    for line in iter(sys.stdin.readline, ''):
+        if line.strip().lower() == 'reset':
+            session.reset()
+            log("Session reset by user")
+            lock_action(esp)
 
 def main():
+    # Flush each log line even when stdout is redirected to a file or pipe.
+    sys.stdout.reconfigure(line_buffering=True)
     try:
         tp = open_port(COM_TP70)
     except Exception as e:
         log(f"Error opening TP70 port: {e}")
         return
+    set_low_latency(tp)
+    read_chunk = make_reader(tp)
 
     esp = None
     if COM_ESP32:
@@ -113,18 +256,32 @@ def main():
         except Exception as e:
             log(f"ESP32 port error: {e}")
 
+    session.last_activity = time.monotonic()
     log("Ready. Waiting for bills...")
 
+    esp_thread = None
+    if esp:
+        esp_thread = threading.Thread(target=esp_writer, args=(esp,), daemon=True)
+        esp_thread.start()
+
     threading.Thread(target=input_listener, args=(tp,esp), daemon=True).start()
 
-    while True:
-        process_tap(tp, esp)
-        if session["active"] and (time.time() - session["last"] > SESSION_TIMEOUT):
-            log("Session timeout. Resetting.")
-            session["amount"] = 0
-            session["active"] = False
-            lock_action(esp)
-        time.sleep(0.05)
+    # process_tap blocks in its read until a byte arrives, so the loop needs no
+    # sleep; the session timeout is checked at least once per READ_TIMEOUT.
+    # Bind the loop's globals/attributes to locals once; the loop runs forever.
+    tap, now = process_tap, time.monotonic
+    try:
+        while True:
+            tap(tp, esp, read_chunk)
+            if session.active and (now() - session.last_activity > SESSION_TIMEOUT):
+                log("Session timeout. Resetting.")
+                session.reset()
+                lock_action(esp)
+    finally:
+        if esp_thread:
+            # Let queued LOCK/UNLOCK commands reach the ESP32 before exiting.
+            esp_queue.put(None)
+            esp_thread.join(timeout=1.0)
 
 if __name__ == "__main__":
     main()